@@ -3,14 +3,37 @@ from discord.ext import commands, tasks
 import asyncio
 import yt_dlp
 import os
-from collections import deque
-import datetime # For formatting duration
+import re
+import urllib.parse
+import time
+import shelve
+import threading
+import atexit
+import contextlib
+import concurrent.futures
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field
+from itertools import islice
 import logging # For more structured logging
+import logging.handlers
+from queue import SimpleQueue
 
 # --- Basic Logging Setup ---
 # This helps differentiate bot instances if multiple are running by mistake
 # and provides more structured output than just print()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - PID:%(process)d - %(message)s')
+# The PID never changes for the life of the process, so look it up once instead of on every log line
+_PID = os.getpid()
+# Records are only queued on the calling thread (usually the event loop); a listener thread formats
+# and writes them, so a slow stderr sink (journald, a pipe) never blocks the loop.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - PID:{pid} - %(message)s'.format(pid=_PID)))
+_log_queue = SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop) # Registered first, so it runs last and flushes everything logged at exit
+# The queued record only carries the message (plus any traceback); the listener's handler adds the rest
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(_log_queue)])
+logging.logProcesses = False # Format no longer uses %(process)d, so skip filling it in on each record
 logger = logging.getLogger(__name__)
 
 
@@ -43,13 +66,37 @@ if not BOT_TOKEN:
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
 logger.info(f"Using FFmpeg path: {FFMPEG_PATH}")
 
+# FFmpeg emits Opus directly and volume is applied there with an audio filter, so Python never
+# touches PCM frames. Set LIVE_VOLUME=1 to use the PCM + PCMVolumeTransformer pipeline instead,
+# which costs more CPU per stream but lets m!volume change the currently playing song.
+LIVE_VOLUME = os.getenv("LIVE_VOLUME", "0").lower() in ("1", "true", "yes")
+logger.info(f"Live volume (PCM pipeline): {LIVE_VOLUME}")
+
+# Number of 20ms frames FFmpeg may run ahead of the voice sender (100 = 2 seconds of audio)
+AUDIO_BUFFER_FRAMES = int(os.getenv("AUDIO_BUFFER_FRAMES", "100"))
+logger.info(f"Audio buffer: {AUDIO_BUFFER_FRAMES} frames")
+
+# Start FFmpeg for the next song this many seconds before the current one ends, hiding the gap between tracks
+PREWARM_SECONDS = 5
+# Re-extract the next song's stream URL this many seconds before the current one ends if it would expire
+PREFETCH_SECONDS = 30
+# Leave the voice channel after this many seconds with nothing playing
+IDLE_DISCONNECT_SECONDS = int(os.getenv("IDLE_DISCONNECT_SECONDS", "300"))
+# Upper bound on queued songs per guild, so a runaway playlist can't grow the queue without limit
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", "500"))
+
 FFMPEG_OPTIONS = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn'  # No video, audio only
+    # -nostdin: never read from the bot's stdin
+    # -fflags nobuffer -flags low_delay -probesize 32 -analyzeduration 0: skip FFmpeg's multi-second
+    # input probing before the first frame; yt-dlp already picked a known audio-only stream
+    'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 '
+                      '-fflags nobuffer -flags low_delay -probesize 32 -analyzeduration 0',
+    'options': '-vn -bufsize 512k'  # No video, audio only
 }
 
 YDL_OPTIONS = {
-    'format': 'bestaudio/best', # Choose best audio format
+    # Prefer YouTube's <=128k Opus audio stream: it matches Discord's codec and is plenty for voice quality
+    'format': 'bestaudio[ext=webm][acodec=opus][abr<=128]/bestaudio[abr<=128]/bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s', # Output template
     'restrictfilenames': True,
     'noplaylist': True,        # When a playlist URL is given, only download the first item.
@@ -64,6 +111,51 @@ YDL_OPTIONS = {
     'source_address': '0.0.0.0'  # Fix for some IPv6 issues
 }
 
+# Playlist extraction only lists the entries (title/id/url); each track's stream URL is
+# resolved later, when it reaches the front of the queue.
+YDL_PLAYLIST_OPTIONS = {**YDL_OPTIONS, 'noplaylist': False, 'extract_flat': 'in_playlist'}
+
+# Searches only need the top result's webpage_url/title/duration; the full format table and signed
+# stream URL are fetched later, when the song reaches the front of the queue.
+YDL_SEARCH_OPTIONS = {**YDL_OPTIONS, 'extract_flat': 'in_playlist', 'skip_download': True, 'playlist_items': '1'}
+
+# Persistent YoutubeDL instances: building one loads every extractor and compiles their regexes,
+# so it is done once instead of on every m!play. A long-lived instance also keeps its HTTP handler,
+# so with the `requests` backend (pulled in by yt-dlp[default]) TCP/TLS connections to YouTube
+# are reused across extractions. YoutubeDL isn't safe to share between threads, so each yt-dlp
+# worker thread keeps its own instance per option set (built on first use).
+_ydl_local = threading.local()
+_ydl_instances = []  # every instance created, closed at exit
+_ydl_instances_lock = threading.Lock()
+
+def _get_ydl(ydl_opts: dict) -> yt_dlp.YoutubeDL:
+    instances = getattr(_ydl_local, 'instances', None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    ydl = instances.get(id(ydl_opts))
+    if ydl is None:
+        ydl = instances[id(ydl_opts)] = yt_dlp.YoutubeDL(ydl_opts)
+        with _ydl_instances_lock:
+            _ydl_instances.append(ydl)
+    return ydl
+
+def _close_ydl_instances():
+    with _ydl_instances_lock:
+        for ydl in _ydl_instances:
+            ydl.close()
+        _ydl_instances.clear()
+
+# Dedicated, bounded thread pool for yt-dlp so extractions don't compete with
+# other blocking work in asyncio's default executor.
+YTDLP_POOL_SIZE = int(os.getenv("YTDLP_POOL_SIZE", "4"))
+_YTDLP_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=YTDLP_POOL_SIZE, thread_name_prefix="ytdlp")
+atexit.register(_close_ydl_instances)
+atexit.register(_YTDLP_POOL.shutdown) # atexit runs in reverse order: the pool is drained before instances close
+# Extra cap on simultaneous YouTube calls (helps avoid 429s), kept even if the pool is ever
+# shared or resized so yt-dlp never has more than YTDLP_POOL_SIZE requests in flight
+_YTDLP_SEMAPHORE = asyncio.Semaphore(YTDLP_POOL_SIZE)
+logger.info(f"yt-dlp thread pool size: {YTDLP_POOL_SIZE}")
+
 # --- Bot Setup ---
 intents = discord.Intents.default()
 intents.message_content = True
@@ -72,116 +164,648 @@ intents.voice_states = True
 bot = commands.Bot(command_prefix="m!", intents=intents)
 
 # --- Per-Guild State Management ---
-music_queues = {}  # guild_id: deque of song_info dictionaries
-current_song_info = {}  # guild_id: song_info dictionary for the currently playing song
-guild_volumes = {} # guild_id: float (volume level, 0.0 to 2.0)
+@dataclass(slots=True)
+class Song:
+    title: str
+    source_url: str | None  # direct audio stream URL; None until resolved for lazily queued songs
+    webpage_url: str
+    duration: int | None
+    uploader: str
+    thumbnail: str | None
+    requester: discord.Member
+    duration_str: str = field(init=False)  # formatted once here, read by queue/nowplaying
+    prewarm: discord.AudioSource | None = None  # audio source started ahead of time, see prewarm_next_songs
+    prewarm_attempted: bool = False
+    acodec: str | None = None  # stream codec reported by yt-dlp, lets FFmpeg start without probing
+    search_query: str | None = None  # m!play search text this song was found with, to search again if it stops resolving
+    status_msg: discord.Message | None = None  # m!play status message, edited to "Now playing" if it starts right away
+
+    def __post_init__(self):
+        self.duration_str = _fmt_dur(self.duration)
+
+@dataclass(slots=True)
+class GuildState:
+    queue: deque = field(default_factory=deque)  # deque of Song
+    current: Song | None = None  # currently playing song
+    volume: float = 0.5  # volume level, 0.0 to 2.0 (default 50%)
+    started_at: float | None = None  # time.monotonic() when the current song started, shifted forward by pauses
+    paused_at: float | None = None  # time.monotonic() when playback was paused
+    resolving: tuple[Song, str | None] | None = None  # (song, source_url it had) last resolved in the background
+    resolve_task: asyncio.Task | None = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # serializes queue/playback transitions
+    idle_since: float | None = None  # time.monotonic() when playback last stopped with an empty queue
+
+_states: dict[int, GuildState] = {}  # guild_id: GuildState
+
+def _get_state(guild_id: int) -> GuildState:
+    state = _states.get(guild_id)
+    if state is None:
+        state = _states[guild_id] = GuildState()
+    return state
+
+def _take_prewarm(song: Song):
+    audio_source = song.prewarm
+    song.prewarm = None
+    song.prewarm_attempted = False
+    return audio_source
+
+def _discard_prewarm(song: Song):
+    audio_source = _take_prewarm(song)
+    if audio_source:
+        audio_source.cleanup() # Kills the FFmpeg process started ahead of time
+
+def _clear_queue(state: GuildState):
+    if state.queue: # Only the queue head is ever prewarmed
+        _discard_prewarm(state.queue[0])
+    if state.resolve_task and not state.resolve_task.done():
+        state.resolve_task.cancel()
+    state.resolving = state.resolve_task = None
+    state.queue.clear()
+    state.current = None
+
+# --- yt-dlp Metadata Cache ---
+# Repeated requests for the same query skip the yt-dlp round-trip entirely.
+# Full results carry a signed stream URL, so an entry lives until that URL's own `expire=`
+# timestamp (minus a safety margin), capped at YTDLP_CACHE_TTL.
+YTDLP_CACHE_MAX = 256
+YTDLP_CACHE_TTL = 1800  # seconds, upper bound for a cached stream URL
+YTDLP_STREAM_EXPIRY_MARGIN = 60  # seconds, drop entries this long before the stream URL stops working
+_YTDLP_CACHE: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()  # normalized query: (expires_at, slim info)
+_YTDLP_CACHE_LOCKS: dict[str, list] = {}  # normalized query: [lock, holder + waiters], avoids duplicate extractions
+_STREAM_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+# Long-lived metadata (title/duration/uploader/thumbnail/webpage_url) per search query, so a repeated
+# search is answered without touching YouTube at all. Entries are dropped after YTDLP_META_TTL, or as
+# soon as the remembered result fails to resolve. Set YTDLP_META_DB to a file path to keep it across restarts.
+YTDLP_META_MAX = 4096
+YTDLP_META_TTL = 7 * 24 * 3600  # seconds
+YTDLP_META_DB = os.getenv("YTDLP_META_DB")
+_YTDLP_META = shelve.open(YTDLP_META_DB) if YTDLP_META_DB else {}
+if YTDLP_META_DB:
+    atexit.register(_YTDLP_META.close)
+    logger.info(f"yt-dlp metadata cache persisted to: {YTDLP_META_DB}")
+
+# Plain YouTube video links are recognized up front so they go straight to the YouTube extractor
+# and share one cache entry per video id, whatever form of the link was pasted.
+_YT_URL_RE = re.compile(r'^https?://(?:www\.|music\.|m\.)?(?:youtube\.com/watch\?v=|youtu\.be/)([\w-]{11})')
 
 
 # --- Helper Functions ---
+def _fmt_dur(duration):
+    # H:MM:SS for songs of an hour or more, M:SS otherwise, using plain integer math
+    if not duration:
+        return "N/A"
+    d = int(duration)
+    if d >= 3600:
+        return f"{d // 3600}:{(d // 60) % 60:02d}:{d % 60:02d}"
+    return f"{d // 60}:{d % 60:02d}"
+
+def _build_embed(title: str, color: int, fields: list, thumbnail: str | None = None, footer: str | None = None) -> discord.Embed:
+    # One dict literal handed to from_dict instead of an Embed plus an add_field() call per field
+    data = {
+        'title': title,
+        'color': color,
+        'fields': fields,
+        'thumbnail': {'url': thumbnail} if thumbnail else None,
+        'footer': {'text': footer} if footer else None,
+    }
+    return discord.Embed.from_dict({k: v for k, v in data.items() if v is not None})
+
+def _now_playing_embed(song: Song) -> discord.Embed:
+    fields = [
+        {'name': "Title", 'value': f"[{song.title}]({song.webpage_url})", 'inline': False},
+        {'name': "Requested by", 'value': song.requester.mention, 'inline': True},
+    ]
+    if song.duration:
+        fields.append({'name': "Duration", 'value': song.duration_str, 'inline': True})
+    if song.uploader:
+        fields.append({'name': "Uploader", 'value': song.uploader, 'inline': True})
+    return _build_embed("Now Playing", 0x2ecc71, fields, thumbnail=song.thumbnail) # discord.Color.green()
+
 async def ensure_voice(ctx: commands.Context):
-    logger.debug(f"ensure_voice called in guild {ctx.guild.id} by {ctx.author.name} (PID: {os.getpid()})")
-    if not ctx.author.voice:
+    voice = ctx.author.voice
+    if voice is None:
         await ctx.send("You are not connected to a voice channel.")
         return None
+    user_channel = voice.channel
+    vc = ctx.voice_client
+    if vc is not None and vc.channel is user_channel: # discord.py caches channel objects, so identity is the common case
+        return vc
 
-    user_channel = ctx.author.voice.channel
-    if not ctx.voice_client: # Bot is not connected to any voice channel in this guild
+    logger.debug("ensure_voice called in guild %s by %s (PID: %d)", ctx.guild.id, ctx.author.name, _PID)
+    if vc is None: # Bot is not connected to any voice channel in this guild
         try:
-            logger.info(f"Bot connecting to voice channel: {user_channel.name} (ID: {user_channel.id}) in guild {ctx.guild.id} (PID: {os.getpid()})")
+            logger.info(f"Bot connecting to voice channel: {user_channel.name} (ID: {user_channel.id}) in guild {ctx.guild.id} (PID: {_PID})")
             vc = await user_channel.connect()
             return vc
         except discord.ClientException as e:
-            logger.error(f"Error connecting to voice channel {user_channel.id} (PID: {os.getpid()}): {e}")
+            logger.error(f"Error connecting to voice channel {user_channel.id} (PID: {_PID}): {e}")
             await ctx.send(f"Error connecting to voice channel: {e}")
             return None
     
-    if ctx.voice_client.channel == user_channel:
-        return ctx.voice_client # Already in the correct channel
+    if vc.channel == user_channel:
+        return vc # Already in the correct channel
     
-    if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
+    if not vc.is_playing() and not vc.is_paused():
         try:
-            logger.info(f"Bot moving to voice channel: {user_channel.name} (ID: {user_channel.id}) in guild {ctx.guild.id} (PID: {os.getpid()})")
-            await ctx.voice_client.move_to(user_channel)
+            logger.info(f"Bot moving to voice channel: {user_channel.name} (ID: {user_channel.id}) in guild {ctx.guild.id} (PID: {_PID})")
+            await vc.move_to(user_channel)
             await ctx.send(f"Moved to **{user_channel.name}**.")
-            return ctx.voice_client
+            return vc
         except Exception as e:
-            logger.error(f"Could not move bot to channel {user_channel.id} (PID: {os.getpid()}): {e}")
+            logger.error(f"Could not move bot to channel {user_channel.id} (PID: {_PID}): {e}")
             await ctx.send(f"Could not move to your channel: {e}")
             return None
     else:
-        logger.warning(f"Bot is busy in {ctx.voice_client.channel.name}, cannot move to {user_channel.name} for {ctx.author.name} (PID: {os.getpid()})")
-        await ctx.send(f"I'm currently busy in **{ctx.voice_client.channel.name}**. Join me there, or wait until I'm free.")
+        logger.warning(f"Bot is busy in {vc.channel.name}, cannot move to {user_channel.name} for {ctx.author.name} (PID: {_PID})")
+        await ctx.send(f"I'm currently busy in **{vc.channel.name}**. Join me there, or wait until I'm free.")
         return None
 
+# All yt-dlp work goes through here. Not asyncio.to_thread: that always uses the default executor,
+# bypassing the dedicated pool and its per-thread YoutubeDL instances.
+async def run_ytdlp(search_query_or_url, ydl_opts=YDL_OPTIONS, ie_key=None):
+    async with _YTDLP_SEMAPHORE:
+        return await asyncio.get_running_loop().run_in_executor(_YTDLP_POOL, extract_yt_info_sync, search_query_or_url, ydl_opts, ie_key)
+
+def extract_yt_info_sync(search_query_or_url, ydl_opts=YDL_OPTIONS, ie_key=None):
+    logger.debug("yt-dlp: Starting extraction for '%s' (PID: %d)", search_query_or_url, _PID)
+    try:
+        info = _get_ydl(ydl_opts).extract_info(search_query_or_url, download=False, ie_key=ie_key)
+        if logger.isEnabledFor(logging.DEBUG): # Don't build the key list unless it will be logged
+            logger.debug("yt-dlp: Extraction successful for '%s'. Info keys: %s", search_query_or_url, info.keys() if info else 'None')
+        return info
+    except yt_dlp.utils.DownloadError as de:
+        # This specifically catches issues like "video unavailable" or region locks during info extraction
+        logger.warning(f"yt-dlp DownloadError for '{search_query_or_url}' (PID: {_PID}): {str(de).splitlines()[0]}") # Log first line
+        return {"_type": "error", "error_msg": str(de)}
+    except Exception as e_sync:
+        logger.error(f"yt-dlp: Unexpected error during sync extraction for '{search_query_or_url}' (PID: {_PID}): {e_sync}", exc_info=True)
+        return {"_type": "error", "error_msg": "An unexpected error occurred during video information retrieval."}
+
+def _slim_info(info: dict) -> dict:
+    # Only what playback and the embeds need. The raw extract_info result also carries the full
+    # format table, thumbnails and every caption track, often hundreds of KB per video.
+    entry = info['entries'][0] if info.get('entries') else info
+    stream_url, acodec = _pick_stream(entry)
+    slim = {'url': stream_url, 'acodec': acodec}
+    for k in ('title', 'duration', 'uploader', 'thumbnail', 'webpage_url'):
+        if entry.get(k) is not None:
+            slim[k] = entry[k]
+    return slim
+
+def _cache_expires_at(info: dict) -> float:
+    now = time.time()
+    expire_match = _STREAM_EXPIRE_RE.search(info.get('url') or "")
+    if expire_match:
+        return min(now + YTDLP_CACHE_TTL, int(expire_match.group(1)) - YTDLP_STREAM_EXPIRY_MARGIN)
+    return now + YTDLP_CACHE_TTL
+
+def _cache_store(key: str, info: dict, expires_at: float):
+    _YTDLP_CACHE[key] = (expires_at, info)
+    _YTDLP_CACHE.move_to_end(key)
+    while len(_YTDLP_CACHE) > YTDLP_CACHE_MAX:
+        _YTDLP_CACHE.popitem(last=False)
+
+@contextlib.asynccontextmanager
+async def _extraction_lock(key: str):
+    # Concurrent requests for the same key wait for a single extraction
+    entry = _YTDLP_CACHE_LOCKS.get(key)
+    if entry is None:
+        entry = _YTDLP_CACHE_LOCKS[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        # Not lock.locked(): that is already False while a woken waiter has yet to re-acquire it,
+        # and a newcomer would get a fresh lock and extract alongside it. Drop it once nobody uses it.
+        entry[1] -= 1
+        if not entry[1]:
+            del _YTDLP_CACHE_LOCKS[key]
+
+def _is_url(query: str) -> bool:
+    return query.strip().startswith(('http://', 'https://'))
+
+def _is_playlist_url(query: str) -> bool:
+    if not _is_url(query):
+        return False
+    parts = urllib.parse.urlsplit(query.strip())
+    if '/playlist' in parts.path:
+        return True
+    # watch?v=ID&list=... (YouTube adds list=RD... to links copied while a mix or radio plays) and
+    # youtu.be/ID?list=... point at one video; play just that one, like noplaylist does
+    params = urllib.parse.parse_qs(parts.query)
+    return 'list' in params and 'v' not in params and not parts.netloc.endswith('youtu.be')
+
+async def search_yt_cached(query: str):
+    key = query.strip().lower()
+    async with _extraction_lock(f"search:{key}"):
+        meta = _YTDLP_META.get(key)
+        if meta and time.time() - meta.get('cached_at', 0) < YTDLP_META_TTL:
+            logger.debug("yt-dlp metadata hit for '%s' -> %s (PID: %d)", key, meta['webpage_url'], _PID)
+            return meta
+
+        info = await run_ytdlp(query.strip(), YDL_SEARCH_OPTIONS)
+        if not info or info.get("_type") == "error":
+            return info
+        entries = info.get('entries') or []
+        entry = entries[0] if entries else None
+        if not entry or not (entry.get('webpage_url') or entry.get('url')):
+            return {"_type": "error", "error_msg": "The search yielded no results."}
+
+        thumbnails = entry.get('thumbnails') or []
+        meta = {
+            'webpage_url': entry.get('webpage_url') or entry.get('url'),
+            'title': entry.get('title', 'Unknown Title'),
+            'duration': entry.get('duration'),
+            'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown Uploader',
+            'thumbnail': entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None),
+            'cached_at': time.time(),
+        }
+        _YTDLP_META[key] = meta
+        if len(_YTDLP_META) > YTDLP_META_MAX:
+            # Drop the oldest tenth in one pass rather than scanning the whole store on every insert
+            by_age = sorted(_YTDLP_META.keys(), key=lambda k: _YTDLP_META[k].get('cached_at', 0))
+            for old_key in by_age[:len(by_age) - YTDLP_META_MAX * 9 // 10]:
+                del _YTDLP_META[old_key]
+        return meta
+
+def _forget_search(query: str):
+    _YTDLP_META.pop(query.strip().lower(), None)
+
+async def extract_yt_info_cached(query: str, min_valid_for: float = 0.0):
+    query = query.strip()
+    yt_match = _YT_URL_RE.match(query)
+    if yt_match:
+        video_id = yt_match.group(1)
+        key = f"yt:{video_id}"
+        query, ie_key = f"https://www.youtube.com/watch?v={video_id}", 'Youtube'
+    elif _is_url(query):
+        key, ie_key = query, None # URLs are case-sensitive
+    else:
+        key, ie_key = query.lower(), None
+    async with _extraction_lock(key):
+        cached = _YTDLP_CACHE.get(key)
+        # Entries already expire YTDLP_STREAM_EXPIRY_MARGIN early; a refresh asking for a URL that lasts
+        # longer than that must not be handed the same expiring URL back
+        if cached and time.time() + max(0.0, min_valid_for - YTDLP_STREAM_EXPIRY_MARGIN) < cached[0]:
+            _YTDLP_CACHE.move_to_end(key)
+            logger.debug("yt-dlp cache hit for '%s' (PID: %d)", key, _PID)
+            return cached[1]
+
+        info = await run_ytdlp(query, YDL_OPTIONS, ie_key)
+        if not info or info.get("_type") == "error": # Never cache failures
+            _YTDLP_CACHE.pop(key, None)
+            return info
+        info = _slim_info(info)
+        if not info['url']: # Nothing playable, let the caller report it
+            _YTDLP_CACHE.pop(key, None)
+            return info
+        expires_at = _cache_expires_at(info)
+        _cache_store(key, info, expires_at)
+        yt_id_match = _YT_URL_RE.match(info.get('webpage_url') or "")
+        if yt_id_match and key != f"yt:{yt_id_match.group(1)}":
+            _cache_store(f"yt:{yt_id_match.group(1)}", info, expires_at) # Pasting the link later hits too
+        return info
+
+def _pick_stream(entry: dict) -> tuple[str | None, str | None]:
+    # (stream URL, audio codec) for an extracted video. yt-dlp normally sets 'url' for the selected
+    # format; when it doesn't (e.g. a merged selection), pick the best audio format from the
+    # format table already in memory instead of making a second request to YouTube.
+    if entry.get('url'):
+        return entry['url'], entry.get('acodec')
+    audio_formats = [f for f in entry.get('formats') or [] if f.get('acodec') not in (None, 'none') and f.get('url')]
+    if not audio_formats:
+        return None, None
+    best = max(audio_formats, key=lambda f: (f.get('vcodec') in (None, 'none'), f.get('abr') or 0)) # Audio-only first
+    return best['url'], best.get('acodec')
+
+def _stream_url_expiring(url: str, within: float) -> bool:
+    # True if a signed stream URL stops working in less than `within` seconds (URLs without an expiry never do)
+    expire_match = _STREAM_EXPIRE_RE.search(url)
+    return bool(expire_match) and int(expire_match.group(1)) - time.time() < within
+
+async def resolve_stream_url(song: Song, min_valid_for: float = YTDLP_STREAM_EXPIRY_MARGIN) -> bool:
+    # Playlist entries are queued without a stream URL, and a song that waited long enough in the
+    # queue may hold one that is about to expire; (re)fetch it once the song is about to play
+    if song.source_url and not _stream_url_expiring(song.source_url, min_valid_for):
+        return True
+    if song.webpage_url == "N/A": # Nothing to re-extract from, try the URL we have
+        return bool(song.source_url)
+    info = await extract_yt_info_cached(song.webpage_url, min_valid_for)
+    stream_url, acodec = _pick_stream(info) if info and info.get("_type") != "error" else (None, None)
+    if not stream_url and song.search_query:
+        # The remembered first result may have gone private or been deleted since; forget it and
+        # search again instead of failing the same way on every later m!play of this text
+        _forget_search(song.search_query)
+        meta = await search_yt_cached(song.search_query)
+        if meta and meta.get("_type") != "error" and meta['webpage_url'] != song.webpage_url:
+            logger.info(f"Search '{song.search_query}' now resolves to {meta['webpage_url']} (PID: {_PID})")
+            song.webpage_url, song.title, song.source_url = meta['webpage_url'], meta['title'], None
+            song.thumbnail, song.duration = meta['thumbnail'], meta['duration']
+            song.duration_str = _fmt_dur(song.duration)
+            info = await extract_yt_info_cached(song.webpage_url, min_valid_for)
+            stream_url, acodec = _pick_stream(info) if info and info.get("_type") != "error" else (None, None)
+        if not stream_url:
+            _forget_search(song.search_query)
+    if not stream_url:
+        logger.warning(f"Could not resolve stream URL for '{song.title}' ({song.webpage_url}) (PID: {_PID})")
+        return bool(song.source_url) # An old URL that hasn't expired yet may still play
+    song.source_url = stream_url
+    song.acodec = acodec
+    if not song.duration and info.get('duration'):
+        song.duration = info['duration']
+        song.duration_str = _fmt_dur(info['duration'])
+    song.thumbnail = song.thumbnail or info.get('thumbnail')
+    if info.get('uploader'):
+        song.uploader = info['uploader']
+    return True
+
 # --- Core Music Playing Logic ---
 
-def play_audio_source(ctx: commands.Context, source_url: str):
+# Reads frames from another source on a background thread so short stalls in FFmpeg's
+# output (network hiccups, reconnects) don't turn into audible gaps.
+class BufferedAudioSource(discord.AudioSource):
+    def __init__(self, inner: discord.AudioSource, frames: int = AUDIO_BUFFER_FRAMES):
+        self._inner = inner
+        self._max_frames = max(1, frames)
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self._eof = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._fill, name="audio-buffer", daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while True:
+                data = self._inner.read()
+                with self._cond:
+                    while len(self._frames) >= self._max_frames and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    if not data: # Inner source is exhausted
+                        return
+                    self._frames.append(data)
+                    self._cond.notify_all()
+        except Exception as e:
+            logger.error(f"Audio buffer reader stopped with an error (PID: {_PID}): {e}", exc_info=True)
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def read(self) -> bytes:
+        with self._cond:
+            while not self._frames and not self._eof and not self._closed:
+                self._cond.wait()
+            if not self._frames: # True end of stream
+                return b''
+            data = self._frames.popleft()
+            self._cond.notify_all()
+            return data
+
+    def is_opus(self) -> bool:
+        return self._inner.is_opus()
+
+    def cleanup(self):
+        with self._cond:
+            self._closed = True
+            self._frames.clear()
+            self._cond.notify_all()
+        self._inner.cleanup()
+
+# PCMVolumeTransformer scales every frame, even at 100% where the result is identical to the input.
+# Skip the multiply in that case and hand the frame through untouched.
+class FastVolumeTransformer(discord.PCMVolumeTransformer):
+    def read(self) -> bytes:
+        if self.volume == 1.0:
+            return self.original.read()
+        return super().read()
+
+async def create_audio_source(source_url: str, volume: float, start_at: float = 0.0, codec: str | None = None):
+    before_options = FFMPEG_OPTIONS['before_options']
+    if start_at > 0:
+        before_options = f"{before_options} -ss {start_at:.2f}" # Input seek, used to restart a song mid-way
+    if LIVE_VOLUME:
+        audio_source = discord.FFmpegPCMAudio(source_url, before_options=before_options, options=FFMPEG_OPTIONS['options'], executable=FFMPEG_PATH)
+        # Buffer below the transformer so m!volume still applies to frames as they are sent
+        return FastVolumeTransformer(BufferedAudioSource(audio_source), volume=volume)
+    if volume == 1.0 and codec and codec != 'none':
+        # No filter needed and yt-dlp already told us the codec: Opus is passed through without
+        # re-encoding, and we skip the ffprobe run (an extra process plus an extra HTTP request)
+        audio_source = discord.FFmpegOpusAudio(source_url, codec=codec, before_options=before_options,
+                                               options=FFMPEG_OPTIONS['options'], executable=FFMPEG_PATH)
+    elif volume == 1.0:
+        # No filter needed: probe the codec so an Opus source can be passed through without re-encoding
+        audio_source = await discord.FFmpegOpusAudio.from_probe(source_url, method='fallback', executable=FFMPEG_PATH,
+                                                                before_options=before_options, options=FFMPEG_OPTIONS['options'])
+    else:
+        # Filtering can't be combined with stream copy, so FFmpeg encodes to Opus itself
+        options = f"{FFMPEG_OPTIONS['options']} -af volume={volume:.2f}"
+        audio_source = discord.FFmpegOpusAudio(source_url, before_options=before_options, options=options, executable=FFMPEG_PATH)
+    return BufferedAudioSource(audio_source)
+
+async def play_audio_source(ctx: commands.Context, source_url: str, audio_source=None, codec: str | None = None):
     guild_id = ctx.guild.id
     vc = ctx.voice_client
-    logger.info(f"play_audio_source called for guild {guild_id} with URL (first ~50 chars): {source_url[:50]} (PID: {os.getpid()})")
+    logger.info(f"play_audio_source called for guild {guild_id} with URL (first ~50 chars): {source_url[:50]} (PID: {_PID})")
 
     if vc and vc.is_connected():
+        playing = False
         try:
-            volume = guild_volumes.get(guild_id, 0.5) # Default volume 50%
-            audio_source = discord.FFmpegPCMAudio(source_url, **FFMPEG_OPTIONS, executable=FFMPEG_PATH)
-            transformed_source = discord.PCMVolumeTransformer(audio_source, volume=volume)
+            state = _get_state(guild_id)
+            if audio_source is None:
+                audio_source = await create_audio_source(source_url, state.volume, codec=codec)
+            else:
+                logger.info(f"Using prewarmed audio source in guild {guild_id} (PID: {_PID})")
             
-            vc.play(transformed_source, after=lambda e: bot.loop.create_task(on_song_end(ctx, e)))
-            logger.info(f"Started playing audio in guild {guild_id} (PID: {os.getpid()})")
+            # `after` runs on discord.py's audio thread, so hand the coroutine to the loop thread-safely
+            loop = asyncio.get_running_loop()
+            vc.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(on_song_end(ctx, e), loop))
+            playing = True # The player owns the source now and cleans it up
+            state.started_at = time.monotonic()
+            state.paused_at = None
+            logger.info(f"Started playing audio in guild {guild_id} (PID: {_PID})")
         except Exception as e:
-            logger.error(f"Error in play_audio_source for guild {guild_id} (PID: {os.getpid()}): {e}", exc_info=True)
-            bot.loop.create_task(ctx.send(f"Error playing audio. See logs for details."))
-            bot.loop.create_task(on_song_end(ctx, e)) # Attempt to cleanup or play next
+            logger.error(f"Error in play_audio_source for guild {guild_id} (PID: {_PID}): {e}", exc_info=True)
+            if audio_source is not None and not playing:
+                # e.g. disconnected during from_probe, or OpusNotLoaded; the buffer thread keeps the
+                # source alive, so it would never be garbage-collected and FFmpeg would keep running
+                audio_source.cleanup()
+            asyncio.create_task(ctx.send(f"Error playing audio. See logs for details."))
+            asyncio.create_task(on_song_end(ctx, e)) # Attempt to cleanup or play next
+    elif audio_source is not None:
+        audio_source.cleanup()
 
 async def on_song_end(ctx: commands.Context, error=None):
     guild_id = ctx.guild.id
     if error:
-        logger.error(f"Player error in guild {guild_id} (PID: {os.getpid()}): {error}", exc_info=True)
+        logger.error(f"Player error in guild {guild_id} (PID: {_PID}): {error}", exc_info=True)
 
-    current_song_info.pop(guild_id, None) # Clear current song for this guild
-    logger.info(f"Song ended or skipped in guild {guild_id}. Checking queue. (PID: {os.getpid()})")
-    
-    if music_queues.get(guild_id): # Check if there are more songs in the queue
-        await play_next_in_queue(ctx)
-    else:
-        logger.info(f"Queue empty for guild {guild_id} after song end. (PID: {os.getpid()})")
-        pass
+    state = _get_state(guild_id)
+    async with state.lock:
+        state.current = None # Clear current song for this guild
+        state.started_at = None
+        logger.info(f"Song ended or skipped in guild {guild_id}. Checking queue. (PID: {_PID})")
+        
+        if state.queue: # Check if there are more songs in the queue
+            await _play_next_locked(ctx, state)
+        else:
+            logger.info(f"Queue empty for guild {guild_id} after song end. (PID: {_PID})")
+            state.idle_since = time.monotonic()
 
 
+async def _announce_now_playing(ctx: commands.Context, song: Song):
+    content = f"Now playing: **{song.title}** (requested by {song.requester.mention})"
+    status_msg, song.status_msg = song.status_msg, None
+    if status_msg: # Reuse the m!play message instead of sending a second one
+        try:
+            await status_msg.edit(content=content)
+            return
+        except discord.HTTPException: # Deleted or no longer editable
+            pass
+    await ctx.send(content)
+
 async def play_next_in_queue(ctx: commands.Context):
+    state = _get_state(ctx.guild.id)
+    async with state.lock:
+        await _play_next_locked(ctx, state)
+
+async def _play_next_locked(ctx: commands.Context, state: GuildState):
+    # Caller must hold state.lock
     guild_id = ctx.guild.id
-    logger.debug(f"play_next_in_queue called for guild {guild_id} (PID: {os.getpid()})")
-    if music_queues.get(guild_id):
-        song = music_queues[guild_id].popleft()
-        current_song_info[guild_id] = song
+    logger.debug("play_next_in_queue called for guild %s (PID: %d)", guild_id, _PID)
+    vc = ctx.voice_client
+    if vc and (vc.is_playing() or vc.is_paused()):
+        # Another command started playback while we waited for the lock
+        logger.debug("play_next_in_queue: already playing in guild %s (PID: %d)", guild_id, _PID)
+        return
+    while state.queue:
+        song = state.queue.popleft()
+        prewarmed_url = song.source_url
+        if not await resolve_stream_url(song):
+            _discard_prewarm(song)
+            status_msg, song.status_msg = song.status_msg, None
+            if status_msg:
+                with contextlib.suppress(discord.HTTPException):
+                    await status_msg.edit(content=f"Could not load **{song.title}**, skipping it.")
+                    continue
+            await ctx.send(f"Could not load **{song.title}**, skipping it.")
+            continue
+        state.current = song
+        state.idle_since = None
         
-        logger.info(f"Playing next in queue for guild {guild_id}: '{song['title']}' requested by {song['requester'].name} (PID: {os.getpid()})")
-        await ctx.send(f"Now playing: **{song['title']}** (requested by {song['requester'].mention})")
-        play_audio_source(ctx, song['source_url'])
-    else:
-        logger.info(f"play_next_in_queue called for guild {guild_id}, but queue is now empty. (PID: {os.getpid()})")
+        logger.info(f"Playing next in queue for guild {guild_id}: '{song.title}' requested by {song.requester.name} (PID: {_PID})")
+        if song.source_url != prewarmed_url: # The prewarmed FFmpeg is reading the old, expiring URL
+            _discard_prewarm(song)
+        await _announce_now_playing(ctx, song)
+        await play_audio_source(ctx, song.source_url, _take_prewarm(song), codec=song.acodec)
+        return
+    logger.info(f"play_next_in_queue called for guild {guild_id}, but queue is now empty. (PID: {_PID})")
+
+
+@tasks.loop(seconds=1)
+async def prewarm_next_songs():
+    now = time.monotonic()
+    for guild_id, state in list(_states.items()):
+        song = state.current
+        if not song or not state.queue or state.started_at is None or state.paused_at is not None:
+            continue
+        next_song = state.queue[0]
+        remaining = song.duration - (now - state.started_at) if song.duration else None
 
+        # Lazily queued (playlist) songs are resolved as soon as they are next, well before the
+        # prewarm window. A stream URL that would expire shortly after the song starts is
+        # refreshed in the last PREFETCH_SECONDS. Either way the track change never waits on yt-dlp.
+        min_valid_for = (remaining or 0) + YTDLP_STREAM_EXPIRY_MARGIN
+        needs_url = next_song.source_url is None or (
+            remaining is not None and remaining <= PREFETCH_SECONDS
+            and _stream_url_expiring(next_song.source_url, min_valid_for)
+        )
+        # Keyed on the URL too, so a song resolved once can still get its URL refreshed later,
+        # but a refresh that returned nothing new isn't retried every second
+        if needs_url and state.resolving != (next_song, next_song.source_url):
+            state.resolving = (next_song, next_song.source_url)
+            state.resolve_task = asyncio.create_task(resolve_stream_url(next_song, min_valid_for))
+        if next_song.source_url is None or (state.resolve_task and not state.resolve_task.done()):
+            continue
+
+        if next_song.prewarm_attempted or remaining is None or remaining > PREWARM_SECONDS:
+            continue
+        if _stream_url_expiring(next_song.source_url, min_valid_for): # Would die mid-song; resolved again at play time
+            continue
+
+        next_song.prewarm_attempted = True # So a failure isn't retried every second
+        try:
+            audio_source = await create_audio_source(next_song.source_url, state.volume, codec=next_song.acodec)
+        except Exception as e:
+            logger.warning(f"Could not prewarm '{next_song.title}' in guild {guild_id} (PID: {_PID}): {e}")
+            continue
+        if state.queue and state.queue[0] is next_song and next_song.prewarm_attempted:
+            next_song.prewarm = audio_source
+            logger.info(f"Prewarmed next song in guild {guild_id}: '{next_song.title}' (PID: {_PID})")
+        else: # Skipped, cleared or already started while FFmpeg was starting
+            audio_source.cleanup()
+
+@tasks.loop(seconds=60)
+async def idle_reaper():
+    # Drop voice connections that have had nothing to play for IDLE_DISCONNECT_SECONDS
+    now = time.monotonic()
+    for vc in list(bot.voice_clients):
+        state = _get_state(vc.guild.id)
+        if vc.is_playing() or vc.is_paused():
+            state.idle_since = None
+            continue
+        if state.idle_since is None: # e.g. joined with m!join and never played
+            state.idle_since = now
+            continue
+        if now - state.idle_since < IDLE_DISCONNECT_SECONDS:
+            continue
+        async with state.lock:
+            if vc.is_playing() or vc.is_paused(): # Something started while we waited
+                continue
+            _clear_queue(state)
+            state.idle_since = None
+        logger.info(f"Disconnecting from idle voice channel in guild {vc.guild.id}. (PID: {_PID})")
+        try:
+            await vc.disconnect()
+        except Exception as e:
+            logger.warning(f"Could not disconnect idle voice client in guild {vc.guild.id} (PID: {_PID}): {e}")
 
 # --- Bot Events ---
 @bot.event
 async def on_ready():
     logger.info(f"Bot '{bot.user.name}' (ID: {bot.user.id}) has connected to Discord!")
-    logger.info(f"Operating with PID: {os.getpid()}") # Crucial for diagnosing multiple instances
+    logger.info(f"Operating with PID: {_PID}") # Crucial for diagnosing multiple instances
     logger.info(f"Command prefix: {bot.command_prefix}")
     if discord.opus.is_loaded():
         logger.info("Opus library (used with PyNaCl for voice) is loaded.")
     else:
         logger.warning("Opus library (used with PyNaCl for voice) is NOT loaded. Voice might not work. "
                        "Ensure libopus is installed on your system if voice issues occur.")
+    if not prewarm_next_songs.is_running():
+        prewarm_next_songs.start()
+    if not idle_reaper.is_running():
+        idle_reaper.start()
     logger.info('Ready to play music!')
 
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    # Kicked or guild deleted: nothing will ever read this guild's state again
+    state = _states.pop(guild.id, None)
+    if state:
+        _clear_queue(state)
+        logger.info(f"Removed from guild {guild.id}, dropped its music state. (PID: {_PID})")
+
 # --- Bot Command Hook for Logging ---
 # This hook runs before every command.
 async def before_invoke_hook(ctx: commands.Context):
     logger.info(
         f"CMD EXEC: '{ctx.command.qualified_name}' by {ctx.author} (ID: {ctx.author.id}) "
         f"in Guild: {ctx.guild.name} (ID: {ctx.guild.id}). "
-        f"Full msg: '{ctx.message.content}'. PID: {os.getpid()}"
+        f"Full msg: '{ctx.message.content}'. PID: {_PID}"
     )
 bot.before_invoke(before_invoke_hook)
 
@@ -213,9 +837,10 @@ async def join(ctx: commands.Context):
 async def leave(ctx: commands.Context):
     guild_id = ctx.guild.id
     if ctx.voice_client:
+        state = _get_state(guild_id)
+        async with state.lock: # Clear first so on_song_end from the disconnect finds nothing to play
+            _clear_queue(state)
         await ctx.voice_client.disconnect()
-        music_queues.pop(guild_id, None)
-        current_song_info.pop(guild_id, None)
         await ctx.send("Disconnected from the voice channel and cleared queue.")
     else:
         await ctx.send("I'm not in a voice channel.")
@@ -228,8 +853,12 @@ async def play(ctx: commands.Context, *, query: str):
     if not vc: # ensure_voice sends its own messages if it fails
         return
 
-    if guild_id not in music_queues:
-        music_queues[guild_id] = deque()
+    if _is_playlist_url(query): # One flat extraction queues the whole playlist
+        return await queue_playlist(ctx, vc, query)
+
+    state = _get_state(guild_id)
+    if len(state.queue) >= MAX_QUEUE_LENGTH:
+        return await ctx.send(f"The queue is full ({MAX_QUEUE_LENGTH} songs). Skip some songs or wait before adding more.")
 
     # Send a "searching" message immediately for better UX
     # You can use a custom loading emoji if your bot has access to one.
@@ -237,29 +866,19 @@ async def play(ctx: commands.Context, *, query: str):
     search_message = await ctx.send(f"Searching for: `{query}` ⏳")
 
     async with ctx.typing(): # Shows "Bot is typing..." for the yt-dlp part
-        loop = asyncio.get_event_loop()
-        
-        def extract_yt_info_sync(search_query_or_url, ydl_opts_sync):
-            logger.debug(f"yt-dlp: Starting extraction for '{search_query_or_url}' (PID: {os.getpid()})")
-            with yt_dlp.YoutubeDL(ydl_opts_sync) as ydl:
-                try:
-                    info = ydl.extract_info(search_query_or_url, download=False)
-                    # logger.debug(f"yt-dlp: Extraction successful for '{search_query_or_url}'. Info keys: {list(info.keys()) if info else 'None'}")
-                    return info
-                except yt_dlp.utils.DownloadError as de:
-                    # This specifically catches issues like "video unavailable" or region locks during info extraction
-                    logger.warning(f"yt-dlp DownloadError for '{search_query_or_url}' (PID: {os.getpid()}): {str(de).splitlines()[0]}") # Log first line
-                    return {"_type": "error", "error_msg": str(de)}
-                except Exception as e_sync:
-                    logger.error(f"yt-dlp: Unexpected error during sync extraction for '{search_query_or_url}' (PID: {os.getpid()}): {e_sync}", exc_info=True)
-                    return {"_type": "error", "error_msg": "An unexpected error occurred during video information retrieval."}
-
         try:
-            raw_info = await loop.run_in_executor(None, extract_yt_info_sync, query, YDL_OPTIONS)
+            is_search = not _is_url(query)
+            # A flat search only pays off when the song waits in the queue; if it will play right
+            # away, one full extraction gets the stream URL too instead of a search plus a resolve
+            lazy = is_search and bool(state.queue or vc.is_playing() or vc.is_paused())
+            if lazy: # Metadata only; the stream URL is resolved when the song comes up
+                raw_info = await search_yt_cached(query)
+            else:
+                raw_info = await extract_yt_info_cached(query)
 
             if not raw_info or raw_info.get("_type") == "error":
                 error_msg = raw_info.get("error_msg", "Could not fetch song information.") if raw_info else "Could not fetch song information."
-                logger.warning(f"Play cmd: yt-dlp failed for query '{query}' in guild {guild_id}. Message: {error_msg} (PID: {os.getpid()}).")
+                logger.warning(f"Play cmd: yt-dlp failed for query '{query}' in guild {guild_id}. Message: {error_msg} (PID: {_PID}).")
                 await search_message.edit(content=f"Could not get information for `{query}`. It might be unavailable, private, or a search yielded no results.")
                 return
 
@@ -271,45 +890,113 @@ async def play(ctx: commands.Context, *, query: str):
                 # This typically means a playlist URL was given, and we take the first item due to 'noplaylist': True.
                 # Or if 'ytsearchN:' (N > 1) was used, but we use 'ytsearch1:'.
                 entry = raw_info['entries'][0]
-                logger.info(f"Play cmd: yt-dlp returned a list of entries for '{query}', using first one: '{entry.get('title', 'N/A')}' (PID: {os.getpid()})")
-            elif 'url' in raw_info: # Expected for single video (from search or direct URL)
+                logger.info(f"Play cmd: yt-dlp returned a list of entries for '{query}', using first one: '{entry.get('title', 'N/A')}' (PID: {_PID})")
+            elif 'url' in raw_info or raw_info.get('formats') or (lazy and raw_info.get('webpage_url')): # Single video (search metadata or direct URL)
                 entry = raw_info
-                logger.info(f"Play cmd: yt-dlp found a single entry for '{query}': '{entry.get('title', 'N/A')}' (PID: {os.getpid()})")
+                logger.info(f"Play cmd: yt-dlp found a single entry for '{query}': '{entry.get('title', 'N/A')}' (PID: {_PID})")
             else:
-                logger.warning(f"Play cmd: yt-dlp returned unexpected structure for query '{query}' in guild {guild_id}. (PID: {os.getpid()}). Keys: {list(raw_info.keys()) if isinstance(raw_info, dict) else 'Not a dict'}")
+                logger.warning("Play cmd: yt-dlp returned unexpected structure for query %r in guild %s. (PID: %d). Keys: %s",
+                               query, guild_id, _PID, raw_info.keys() if isinstance(raw_info, dict) else 'Not a dict')
                 await search_message.edit(content=f"Could not find a playable track from your query: `{query}`.")
                 return
             
-            stream_url = entry.get('url') # This should be the direct audio stream URL
-            if not stream_url:
-                logger.error(f"Play cmd: No stream_url in yt-dlp entry for '{entry.get('title', query)}' despite extraction. (PID: {os.getpid()}). Entry keys: {list(entry.keys())}")
+            stream_url, acodec = (None, None) if lazy else _pick_stream(entry) # Direct audio stream URL
+            if not stream_url and not lazy:
+                logger.error("Play cmd: No stream_url in yt-dlp entry for '%s' despite extraction. (PID: %d). Entry keys: %s",
+                             entry.get('title', query), _PID, entry.keys())
                 await search_message.edit(content="Found video information, but couldn't get a playable audio stream. The format might be unsupported.")
                 return
 
-            song_details = {
-                'webpage_url': entry.get('webpage_url', "N/A"),
-                'title': entry.get('title', 'Unknown Title'),
-                'duration': entry.get('duration'),
-                'uploader': entry.get('uploader', 'Unknown Uploader'),
-                'thumbnail': entry.get('thumbnail'),
-                'requester': ctx.author,
-                'source_url': stream_url
-            }
+            song_details = Song(
+                webpage_url=entry.get('webpage_url', "N/A"),
+                title=entry.get('title', 'Unknown Title'),
+                duration=entry.get('duration'),
+                uploader=entry.get('uploader', 'Unknown Uploader'),
+                thumbnail=entry.get('thumbnail'),
+                requester=ctx.author,
+                source_url=stream_url,
+                acodec=acodec,
+                search_query=query if is_search else None
+            )
 
-            music_queues[guild_id].append(song_details)
-            await search_message.edit(content=f"Added to queue: **{song_details['title']}**")
-            logger.info(f"Play cmd: Added '{song_details['title']}' to queue in guild {guild_id} (PID: {os.getpid()})")
+            if not state.queue and not vc.is_playing() and not vc.is_paused():
+                song_details.status_msg = search_message # Starts right away, "Now playing" edits this message
+            else:
+                await search_message.edit(content=f"Added to queue: **{song_details.title}**")
+            state.queue.append(song_details)
+            logger.info(f"Play cmd: Added '{song_details.title}' to queue in guild {guild_id} (PID: {_PID})")
 
         except Exception as e:
-            logger.error(f"Play cmd: Unexpected error for query '{query}' in guild {guild_id} (PID: {os.getpid()}): {e}", exc_info=True)
+            logger.error(f"Play cmd: Unexpected error for query '{query}' in guild {guild_id} (PID: {_PID}): {e}", exc_info=True)
             await search_message.edit(content=f"An unexpected error occurred while trying to process your request.")
             return
 
     if not vc.is_playing() and not vc.is_paused():
-        logger.info(f"Play cmd: VC not playing in guild {guild_id}, starting playback. (PID: {os.getpid()})")
+        logger.info(f"Play cmd: VC not playing in guild {guild_id}, starting playback. (PID: {_PID})")
         await play_next_in_queue(ctx)
     else:
-        logger.info(f"Play cmd: VC already playing/paused in guild {guild_id}, song queued. (PID: {os.getpid()})")
+        logger.info(f"Play cmd: VC already playing/paused in guild {guild_id}, song queued. (PID: {_PID})")
+    # Another m!play may have started its song first; this one is waiting in the queue after all
+    status_msg = song_details.status_msg
+    if status_msg and any(s is song_details for s in state.queue):
+        song_details.status_msg = None # Its "Now playing" will be a new message
+        with contextlib.suppress(discord.HTTPException):
+            await status_msg.edit(content=f"Added to queue: **{song_details.title}**")
+
+@bot.command(name='addplaylist', aliases=['pl'], help='Queues every song from a YouTube playlist URL.')
+async def playlist_cmd(ctx: commands.Context, *, url: str):
+    vc = await ensure_voice(ctx)
+    if not vc:
+        return
+    await queue_playlist(ctx, vc, url)
+
+async def queue_playlist(ctx: commands.Context, vc: discord.VoiceClient, url: str):
+    guild_id = ctx.guild.id
+    state = _get_state(guild_id)
+    if len(state.queue) >= MAX_QUEUE_LENGTH:
+        return await ctx.send(f"The queue is full ({MAX_QUEUE_LENGTH} songs). Skip some songs or wait before adding more.")
+    search_message = await ctx.send(f"Loading playlist: `{url}` ⏳")
+
+    async with ctx.typing():
+        try:
+            # A single flat extraction lists every entry; stream URLs are resolved lazily per song
+            raw_info = await run_ytdlp(url, YDL_PLAYLIST_OPTIONS)
+
+            if not raw_info or raw_info.get("_type") == "error":
+                logger.warning(f"Playlist cmd: yt-dlp failed for '{url}' in guild {guild_id} (PID: {_PID}).")
+                await search_message.edit(content=f"Could not load the playlist `{url}`. It might be private or unavailable.")
+                return
+
+            entries = [e for e in (raw_info.get('entries') or []) if e and (e.get('webpage_url') or e.get('url'))]
+            if not entries:
+                await search_message.edit(content=f"No playable songs found in `{url}`.")
+                return
+            # Not deque(maxlen=...): that would silently drop the oldest queued songs instead
+            total = len(entries)
+            entries = entries[:max(MAX_QUEUE_LENGTH - len(state.queue), 0)]
+
+            state.queue.extend([Song(
+                webpage_url=e.get('webpage_url') or e.get('url'),
+                title=e.get('title', 'Unknown Title'),
+                duration=e.get('duration'),
+                uploader=e.get('uploader', 'Unknown Uploader'),
+                thumbnail=None,
+                requester=ctx.author,
+                source_url=None # Resolved by resolve_stream_url() when the song comes up
+            ) for e in entries])
+
+            playlist_title = raw_info.get('title', 'playlist')
+            note = f" (queue limit reached, {total - len(entries)} skipped)" if len(entries) < total else ""
+            await search_message.edit(content=f"Added {len(entries)} song(s) from **{playlist_title}** to the queue{note}.")
+            logger.info(f"Playlist cmd: Added {len(entries)} songs from '{playlist_title}' to queue in guild {guild_id} (PID: {_PID})")
+
+        except Exception as e:
+            logger.error(f"Playlist cmd: Unexpected error for '{url}' in guild {guild_id} (PID: {_PID}): {e}", exc_info=True)
+            await search_message.edit(content="An unexpected error occurred while trying to load the playlist.")
+            return
+
+    if not vc.is_playing() and not vc.is_paused():
+        await play_next_in_queue(ctx)
 
 # ... (skip, stop, pause, resume, queue, nowplaying, volume commands remain largely the same, but would benefit from PID in their logs too if debugging extensively)
 # For brevity, I'll skip adding PID to every single log line in those, but the pattern is established.
@@ -317,8 +1004,14 @@ async def play(ctx: commands.Context, *, query: str):
 @bot.command(name='skip', aliases=['s'], help='Skips the current song.')
 async def skip(ctx: commands.Context):
     vc = ctx.voice_client
-    if vc and (vc.is_playing() or vc.is_paused()):
-        vc.stop()
+    state = _get_state(ctx.guild.id)
+    if state.lock.locked(): # A song transition is in progress; stopping now would skip the song it is starting
+        return await ctx.send("Already transitioning to the next song, try again in a moment.")
+    async with state.lock:
+        skipped = bool(vc and (vc.is_playing() or vc.is_paused()))
+        if skipped:
+            vc.stop()
+    if skipped:
         await ctx.send("Skipped current song.")
     else:
         await ctx.send("Not playing anything or queue is empty, nothing to skip.")
@@ -328,10 +1021,11 @@ async def stop(ctx: commands.Context):
     guild_id = ctx.guild.id
     vc = ctx.voice_client
     if vc:
-        music_queues.pop(guild_id, None)
-        current_song_info.pop(guild_id, None)
-        if vc.is_playing() or vc.is_paused():
-            vc.stop()
+        state = _get_state(guild_id)
+        async with state.lock:
+            _clear_queue(state)
+            if vc.is_playing() or vc.is_paused():
+                vc.stop()
         await vc.disconnect()
         await ctx.send("Playback stopped, queue cleared, and disconnected.")
     else:
@@ -343,6 +1037,7 @@ async def pause(ctx: commands.Context):
     vc = ctx.voice_client
     if vc and vc.is_playing():
         vc.pause()
+        _get_state(ctx.guild.id).paused_at = time.monotonic()
         await ctx.send("Paused playback. Use `m!resume` to continue.")
     else:
         await ctx.send("Not playing anything or already paused.")
@@ -352,6 +1047,10 @@ async def resume(ctx: commands.Context):
     vc = ctx.voice_client
     if vc and vc.is_paused():
         vc.resume()
+        state = _get_state(ctx.guild.id)
+        if state.paused_at is not None and state.started_at is not None:
+            state.started_at += time.monotonic() - state.paused_at # Paused time doesn't count as elapsed
+        state.paused_at = None
         await ctx.send("Resumed playback.")
     else:
         await ctx.send("Not paused or nothing to resume.")
@@ -359,72 +1058,59 @@ async def resume(ctx: commands.Context):
 
 @bot.command(name='queue', aliases=['q', 'playlist'], help='Shows the current song queue.')
 async def queue_cmd(ctx: commands.Context):
-    guild_id = ctx.guild.id
-    queue = music_queues.get(guild_id)
-    embed = discord.Embed(title="Music Queue", color=discord.Color.blue())
+    state = _get_state(ctx.guild.id)
+    queue = state.queue
+    fields = []
+    thumbnail = None
     
-    song_now = current_song_info.get(guild_id)
+    song_now = state.current
     if song_now and ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-        duration_str = str(datetime.timedelta(seconds=int(song_now.get('duration', 0)))) if song_now.get('duration') else "N/A"
-        embed.add_field(
-            name="Now Playing", 
-            value=f"[{song_now['title']}]({song_now['webpage_url']}) | `{duration_str}` | Req by: {song_now['requester'].mention}", 
-            inline=False
-        )
-        if song_now.get('thumbnail'):
-            embed.set_thumbnail(url=song_now['thumbnail'])
+        fields.append({
+            'name': "Now Playing",
+            'value': f"[{song_now.title}]({song_now.webpage_url}) | `{song_now.duration_str}` | Req by: {song_now.requester.mention}",
+            'inline': False
+        })
+        thumbnail = song_now.thumbnail
     
     if not queue:
         if not song_now: # No current song and no queue
             await ctx.send("The queue is currently empty.")
             return
         else: # Only current song is playing
-            await ctx.send(embed=embed)
+            await ctx.send(embed=_build_embed("Music Queue", 0x3498db, fields, thumbnail)) # discord.Color.blue()
             return
 
-    queue_list_str = ""
-    for i, song_item in enumerate(list(queue)[:10]):
-        duration_str = str(datetime.timedelta(seconds=int(song_item.get('duration', 0)))) if song_item.get('duration') else "N/A"
-        queue_list_str += f"{i+1}. [{song_item['title']}]({song_item['webpage_url']}) | `{duration_str}` | Req by: {song_item['requester'].mention}\n"
+    queue_list_str = "\n".join(
+        f"{i+1}. [{song_item.title}]({song_item.webpage_url}) | `{song_item.duration_str}` | Req by: {song_item.requester.mention}"
+        for i, song_item in enumerate(islice(queue, 10))
+    )
     
     if queue_list_str: # Add "Up Next" field only if there are songs in the string
-        embed.add_field(name="Up Next", value=queue_list_str, inline=False)
+        fields.append({'name': "Up Next", 'value': queue_list_str, 'inline': False})
 
-    if len(queue) > 10:
-        embed.set_footer(text=f"...and {len(queue) - 10} more song(s).")
+    footer = None
+    queue_len = len(queue)
+    if queue_len > 10:
+        footer = f"...and {queue_len - 10} more song(s)."
     elif not queue_list_str and not song_now: # Should be caught by the first check
          await ctx.send("The queue is currently empty.")
          return
         
-    await ctx.send(embed=embed)
+    await ctx.send(embed=_build_embed("Music Queue", 0x3498db, fields, thumbnail, footer))
 
 
 @bot.command(name='nowplaying', aliases=['np', 'current'], help='Shows the currently playing song.')
 async def nowplaying_cmd(ctx: commands.Context):
-    guild_id = ctx.guild.id
-    song = current_song_info.get(guild_id)
+    song = _get_state(ctx.guild.id).current
     vc = ctx.voice_client
 
     if song and vc and (vc.is_playing() or vc.is_paused()):
-        embed = discord.Embed(title="Now Playing", color=discord.Color.green())
-        embed.add_field(name="Title", value=f"[{song['title']}]({song['webpage_url']})", inline=False)
-        embed.add_field(name="Requested by", value=song['requester'].mention, inline=True)
-        
-        if song.get('duration'):
-            duration_str = str(datetime.timedelta(seconds=int(song['duration'])))
-            embed.add_field(name="Duration", value=duration_str, inline=True)
-        if song.get('uploader'):
-            embed.add_field(name="Uploader", value=song['uploader'], inline=True)
-        if song.get('thumbnail'):
-            embed.set_thumbnail(url=song['thumbnail'])
-        
-        await ctx.send(embed=embed)
+        await ctx.send(embed=_now_playing_embed(song))
     else:
         await ctx.send("Not currently playing any song.")
 
 @bot.command(name='volume', aliases=['vol'], help='Changes player volume (0-200). Default: 50. Usage: m!volume <number>')
 async def volume(ctx: commands.Context, new_volume: int):
-    guild_id = ctx.guild.id
     vc = ctx.voice_client
 
     if not vc or not (vc.is_playing() or vc.is_paused()):
@@ -434,13 +1120,40 @@ async def volume(ctx: commands.Context, new_volume: int):
         return await ctx.send("Volume must be between 0 and 200.")
 
     actual_volume = new_volume / 100.0
-    guild_volumes[guild_id] = actual_volume
+    state = _get_state(ctx.guild.id)
+    state.volume = actual_volume
+    if state.queue: # A prewarmed next song was started with the old volume
+        _discard_prewarm(state.queue[0])
 
     if vc.source and hasattr(vc.source, 'volume'):
         vc.source.volume = actual_volume
         await ctx.send(f"Volume set to {new_volume}%.")
-    else:
-        await ctx.send(f"Volume will be set to {new_volume}% for the next song (could not adjust current source).")
+        return
+
+    # Opus pipeline: the volume is baked into the FFmpeg filter, so restart FFmpeg at the
+    # current position with the new filter and swap it in without ending the song
+    song = state.current
+    if song and song.source_url and state.started_at is not None:
+        elapsed = (state.paused_at or time.monotonic()) - state.started_at
+        try:
+            new_source = await create_audio_source(song.source_url, actual_volume, start_at=elapsed, codec=song.acodec)
+        except Exception as e:
+            logger.warning(f"Could not restart stream with new volume in guild {ctx.guild.id} (PID: {_PID}): {e}")
+        else:
+            async with state.lock:
+                if state.current is song and vc.source and (vc.is_playing() or vc.is_paused()):
+                    old_source = vc.source
+                    was_paused = vc.is_paused()
+                    vc.source = new_source # set_source() resumes the player...
+                    if was_paused:
+                        vc.pause() # ...so keep a paused song paused
+                    # The audio thread may still be inside old_source.read(); cleaning up now would make
+                    # that read return b'' and end the song, so give it a moment to move to new_source
+                    asyncio.get_running_loop().call_later(0.1, old_source.cleanup)
+                    await ctx.send(f"Volume set to {new_volume}%.")
+                    return
+            new_source.cleanup() # The song changed while FFmpeg was starting
+    await ctx.send(f"Volume will be set to {new_volume}% for the next song (could not adjust current source).")
 
 # --- Error Handling for commands ---
 @bot.event
@@ -449,7 +1162,7 @@ async def on__command_error(ctx: commands.Context, error):
     logger.error(
         f"Error in command '{ctx.command.qualified_name if ctx.command else 'UnknownCommand'}'. "
         f"Invoked by: {ctx.author}. Message: '{ctx.message.content}'. "
-        f"PID: {os.getpid()}. Error: {type(error).__name__}: {error}",
+        f"PID: {_PID}. Error: {type(error).__name__}: {error}",
         exc_info=True if not isinstance(error, (commands.CommandNotFound, commands.MissingRequiredArgument, commands.BadArgument)) else False
     )
 
@@ -481,7 +1194,7 @@ if __name__ == "__main__":
         exit()
     else:
         try:
-            logger.info(f"Attempting to start the bot with PID: {os.getpid()}...")
+            logger.info(f"Attempting to start the bot with PID: {_PID}...")
             # When using custom logging setup, pass log_handler=None to bot.run
             # to prevent discord.py from configuring the root logger.
             bot.run(BOT_TOKEN, log_handler=None)